@@ -19,16 +19,21 @@
 #
 
 import re
+import asyncio
+import atexit
+import heapq
 import serial
+import serial_asyncio_fast
 import time
-import threading
-import signal
 import os
+import sys
 import socket
 import Adafruit_DHT as dht
 import psutil
-from enum import Enum
-from gpiozero import CPUTemperature
+try:
+  from systemd import daemon   # optional, only used to tell systemd we are stopping
+except ImportError:
+  daemon = None
 
 # User specific constants (please fill these out accordingly)
 USER = "VE3YSH-9"
@@ -40,6 +45,9 @@ SERIAL_PORT = '/dev/ttyUSB0' # Linux
 
 # DHT22 specific constants
 DHT = 4 # DHT22 data pin
+DHT_INTERVAL_S = 15
+DHT_MAX_AGE_S = 4 * DHT_INTERVAL_S    # older readings are dropped from telemetry
+DHT_FIRST_READ_S = 35                 # read_retry gives up after ~30s
 
 # Telemetry constants and variables
 SEQUENCE_NUMBER = 10
@@ -51,7 +59,7 @@ HOST = "noam.aprs2.net"  # north america tier2 servers round robin
 PORT = 14580
 ICON = "&"
 OVERLAY = "R"
-BUFFER_SIZE = 512
+TCP_USER_TIMEOUT_MS = 15000  # drop a stuck server after 15s of unacknowledged data
 
 # My position string constants
 POSITION = LAT + OVERLAY + LONG
@@ -59,95 +67,140 @@ TO_CALL = ">APZYG2"  # Software version used as TOCALL
 MESSAGE = "Yaesu ygate https://github.com/craigerl/ygate"
 PREFIX = USER + TO_CALL + ",TCPIP*:"
 MY_POSITION_STRING = USER + TO_CALL + ",TCPIP*:!" + POSITION + ICON + MESSAGE
-MY_SYSTEM_DATA_STRING = ""
 MY_LOGIN_STRING = "user " + USER + " pass " +  PASS + " vers ygate.py 2.00\n"
 BEACON_INTERVAL_S = 1800
 TELEMETRY_INTERVAL_S = 300
 SERIAL_TIMEOUT_S = 10
+SERIAL_READ_SIZE = 1024
+
+# Pre-encoded frames, the steady state send path never re-encodes these
+_CRLF = b"\r\n"
+_PREFIX_B = PREFIX.encode('utf-8')
+_LOGIN_B = MY_LOGIN_STRING.encode('utf-8')
+_MY_POSITION_B = (MY_POSITION_STRING + "\r\n").encode('utf-8')
+_PARAMS_B = (PREFIX + PARAMETER_NAMES + "\r\n").encode('utf-8')
+_UNITS_B = (PREFIX + UNIT_MESSAGE + "\r\n").encode('utf-8')
+_EQNS_B = (PREFIX + EQUATION_COEF + "\r\n").encode('utf-8')
+
+# Appended to the routing block of every gated packet
+_QAO_USER = ',qAO,' + USER + ':'
+
+# Every 3 digit telemetry field, indexed by value
+_DIGITS3 = [b"%03d" % n for n in range(1000)]
+
+# Third party internet packet pattern
+_RE_THIRDPARTY_TCP = re.compile(r'^\}.*,TCP.*:')
 
 # Object position string constants
 OBJ1_STRING = "VE3RLR-V" + TO_CALL + ",TCPIP*:!" + "4454.12N" + "D" + "07601.70W" + ICON + "147.210MHz T151 +060 C4FM AMS http://ve3rlr.ca/"
 
-# State Machine definitions
-class AprsIsState(Enum):
-  NOCONNECT = 1
-  CONNECTED = 2
-  LOGGED_IN = 3
+# Telemetry analog/sequence field, clamped to 000-999
+def _enc3(n):
+  return _DIGITS3[max(0, min(999, n))]
 
-# DHT22 handler
+# Latest DHT22 reading (degC, %RH, monotonic time read), refreshed in the background
+# by dht_task(). None until the sensor has given us a real reading
+_dht_latest = None
+_dht_first_read = None   # asyncio.Event set once dht_task() has tried the sensor
+
+# DHT22 handler, never blocks on the sensor. Returns the telemetry fields, or None if
+# there is no recent reading so we don't publish made up or stale values
 def readDht22():
-  h,t = dht.read_retry(dht.DHT22, DHT)
+  if _dht_latest is None:
+    print("DHT22 no reading yet")
+    return None
+  t,h,read_time = _dht_latest
+  if time.monotonic() - read_time > DHT_MAX_AGE_S:
+    print("DHT22 reading is stale, last one " + f"{time.monotonic() - read_time:.0f}" + "s ago")
+    return None
   print("DHT22 data " + f"{t:.1f}" + " degC, " + f"{h:.0f}" + "%")
-  return f"{int(round((t+50)*2)):03d}," + f"{int(round(h*2)):03d}"
-
-# CPU load
-def getCPULoad():
-  load = psutil.getloadavg()[0] / psutil.cpu_count() * 100
-  return f"{int(round(load,0))}"
-
-# Ctrl-c handler
-def signal_handler(signal, frame):
-  print(">>> Ctrl+C detected, exiting...")
-  sock.shutdown(0)
-  sock.close()
-  ser.close
-  time.sleep(2)
-  os._exit(0)
-
-# Setup a socket for connection to APRS-IS server
-def setup_socket(buffer_size):
-  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  sock_file = sock.makefile(mode='r')
-  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # disable nagle algorithm
-  sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
-  return sock, sock_file
+  return _enc3(round((t+50)*2)) + b"," + _enc3(round(h*2))
+
+# CPU sensors
+_CPU_COUNT = psutil.cpu_count() or 1
+CPU_TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
+_TEMP_FD = os.open(CPU_TEMP_PATH, os.O_RDONLY)   # kept open, re-read from the start each tick
+atexit.register(os.close, _TEMP_FD)
+LOADAVG_CACHE_S = 30
+_loadavg = None
+_loadavg_time = 0.0
+
+# CPU temperature in degC, straight from sysfs (millidegrees)
+def _cpu_temp_c():
+  os.lseek(_TEMP_FD, 0, os.SEEK_SET)
+  return int(os.read(_TEMP_FD, 16)) / 1000.0
+
+# 1 minute load average, kernel only updates it every 5s so reuse a recent value
+def getLoadAvg():
+  global _loadavg, _loadavg_time
+  now = time.monotonic()
+  if _loadavg is None or now - _loadavg_time > LOADAVG_CACHE_S:
+    _loadavg = psutil.getloadavg()[0]
+    _loadavg_time = now
+  return _loadavg
 
 # Shutdown/close socket
 def reset_socket():
+  global sock_reader, sock_writer
+  if sock_writer is None:
+    return
   try:
-    sock.shutdown(0)
-    sock.close()
-  except Exception as e:
+    sock_writer.close()
+  except OSError as e:
     print(">>> FAILED to close socket\n")
     print(e)
-
-# Try to connect to aprs-is
-def connect_to_server():
-  success = False
-  try:
-    sock.connect((HOST, PORT))
-    success = True
-  except Exception as e:
-    print(">>> FAILED connect to " + HOST + "\n")
-    print(e)
-  finally:
-    return success
-
-# Try to send to aprs-is
-def send_to_server(packet_string):
-  success = False
-  try:
-    sock.send(bytes(packet_string, 'utf-8'))
-    success = True
-  except Exception as e:
-    print(">>> FAILED send " + packet_string)
-    print(e)
-  finally:
-    return success
-
-
-# Register the ctrl-c signal handler
-signal.signal(signal.SIGINT, signal_handler)
-
-# Open the specified serial port
-try:
-  ser = serial.Serial(SERIAL_PORT, 9600, timeout=SERIAL_TIMEOUT_S)
-except Exception as e:
-  print(">>> FAILED to open " + SERIAL_PORT + "\n")
-  print(e)
-  os._exit(1)  # If we can't do this, we're done!
-
-run_state = AprsIsState.NOCONNECT
+  sock_reader, sock_writer = None, None
+
+# Close the ports and exit, telling systemd (if running under it) that we are shutting down
+def _die(code):
+  reset_socket()
+  if ser_writer is not None:
+    ser_writer.close()
+  if daemon is not None:
+    daemon.notify('STOPPING=1')
+  sys.exit(code)
+
+# Read one line from aprs-is, raises ConnectionResetError if the server hung up
+async def read_server_line():
+  line = await sock_reader.readline()
+  if not line:
+    raise ConnectionResetError(HOST + " closed the connection")
+  return line.decode('utf-8', errors='ignore').strip()
+
+# Connect to aprs-is and login, raises OSError if the connection fails
+async def connect_to_server():
+  global sock_reader, sock_writer
+  sock_reader, sock_writer = await asyncio.open_connection(HOST, PORT)
+  sock = sock_writer.transport.get_extra_info('socket')
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # disable nagle algorithm
+  if hasattr(socket, 'TCP_USER_TIMEOUT'):  # Linux only
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, TCP_USER_TIMEOUT_MS)
+  await send_to_server(_LOGIN_B)
+  version = await read_server_line()
+  print(version)
+  login_response = await read_server_line()
+  print(login_response)
+  if ("verified" in login_response):
+    print("Login SUCCESS\n")
+  else:
+    print("Login FAILURE\n")
+    _die(1)  # If we can't do this, we're done!
+
+# Send one or more frames to aprs-is in a single write, raises OSError if the connection is gone
+async def send_to_server(*frames):
+  sock_writer.writelines(frames)
+  await sock_writer.drain()
+
+# Routing block of a Yaesu header line with us appended, None if the line isn't a header
+# Same match as the old ' \[.*\] <UI.*>:' regex: first ' [', then '] <UI', then the last '>:'.
+# Anything after that '>:' is kept, as re.sub() did
+def yaesu_routing(line):
+  routing, sep, suffix = line.partition(' [')
+  ui = suffix.find('] <UI')
+  end = suffix.rfind('>:')
+  if (sep and ui >= 0 and end >= ui + 5):        # Yaesu's nmea9-formatted suffix means we found a routing block
+    return routing + _QAO_USER + suffix[end + 2:]  # drop nmea/yaesu gunk, append us to routing block
+  return None
 
 # read nmea9 sentences from yaesu radio
 # arrange them into aprs packet strings
@@ -162,125 +215,202 @@ run_state = AprsIsState.NOCONNECT
 # after removing a random number of yaesu-injected line feeds we rearrange into a real APRS packet like this:
 #    AA6I>APOTU0,K6IXA-3,VACA,WIDE2*,qAO,KM6XXX-1:/022047z3632.30N/11935.16Wk136/055/A=000300ENROUTE
 #
-
-# Force sending my position and telemetry first time around
-last_beacon_time = time.time() - BEACON_INTERVAL_S
-last_telemetry_time = last_beacon_time - TELEMETRY_INTERVAL_S
-
-while True:
-
-  match run_state:
-
-    case AprsIsState.NOCONNECT:
-        sock, sock_file = setup_socket(BUFFER_SIZE)
-        if (connect_to_server() == True):
-          run_state = AprsIsState.CONNECTED
-        else:
-          reset_socket()
-          time.sleep(5)
-
-    case AprsIsState.CONNECTED:
-        if (send_to_server(MY_LOGIN_STRING) == True):
-          version = sock_file.readline().strip()
-          print(version)
-          login_response = sock_file.readline().strip()
-          print(login_response)
-          if ("verified" in login_response):
-            print("Login SUCCESS\n")
-            run_state = AprsIsState.LOGGED_IN
-          else:
-            print("Login FAILURE\n")
-            sock.shutdown(0)
-            sock.close()
-            ser.close()
-            os._exit(1)  # If we can't do this, we're done!
-
-    case AprsIsState.LOGGED_IN:
-      line = ser.readline()
-
-      # Check to see if its time to beacon
-
-      current_time = time.time()
-
-      if (current_time - last_telemetry_time > TELEMETRY_INTERVAL_S):
-        cpu = CPUTemperature()
-        load = getCPULoad()
-        print("CPU Temp: " + str(round(cpu.temperature, 1)) + "CPU Load: " + load + "%")
-        thStr = readDht22()
-        telem = "T#" + f"{SEQUENCE_NUMBER:03d}," + f"{int(round(cpu.temperature*2)):03d}," + getCPULoad() + "," + thStr 
-        send_to_server(PREFIX + telem + "\r\n")
-        SEQUENCE_NUMBER = (SEQUENCE_NUMBER + 1) % 1000
-        print(PREFIX + telem)
-        last_telemetry_time = current_time
-
-      if (current_time - last_beacon_time > BEACON_INTERVAL_S):
-        if (send_to_server(MY_POSITION_STRING + "\r\n") == False):
-          reset_socket()
-          time.sleep(5)
-          run_state = AprsIsState.NOCONNECT
-        else:
-          print(MY_POSITION_STRING)
-          last_beacon_time = current_time
-          send_to_server(PREFIX + PARAMETER_NAMES + "\r\n")
-          print(PREFIX + PARAMETER_NAMES) 
-          send_to_server(PREFIX + UNIT_MESSAGE + "\r\n")
-          print(PREFIX + UNIT_MESSAGE)
-          send_to_server(PREFIX + EQUATION_COEF + "\r\n")
-          print(PREFIX + EQUATION_COEF)
-          #send_to_server(OBJ1_STRING + "\r\n")
-          #print(OBJ1_STRING)
-
-      if not line:
+async def read_radio():
+  rx_buf = bytearray()
+
+  # Hot loop names bound as locals, once per session
+  ser_read = ser_reader.read
+  rx_find = rx_buf.find
+  rx_extend = rx_buf.extend
+  routing_of = yaesu_routing
+  thirdparty_tcp = _RE_THIRDPARTY_TCP.search
+  wait_for = asyncio.wait_for
+  send = send_to_server
+
+  # Next line from the radio, each read drains everything waiting on the port into rx_buf
+  async def readline():
+    while (end := rx_find(b'\n')) < 0:
+      chunk = await ser_read(SERIAL_READ_SIZE)
+      if not chunk:
+        raise EOFError(SERIAL_PORT + " closed")
+      rx_extend(chunk)
+    line = bytes(rx_buf[:end]).decode('utf-8', errors='ignore').strip('\n\r')
+    del rx_buf[:end + 1]
+    return line
+
+  # Next non-empty line, the random number of yaesu line feeds are dropped from the buffer
+  async def read_payload():
+    while not (line := await readline()):
+      pass
+    return line
+
+  line = None
+  while True:
+    if line is None:
+      line = await readline()
+    routing = routing_of(line)
+    line = None
+    if routing is not None:
+      try:
+        payload = await wait_for(read_payload(), SERIAL_TIMEOUT_S)
+      except asyncio.TimeoutError:
+        payload = ''
+      if (routing_of(payload) is not None):     # header without a payload, the next header is handled on the next pass
+        line = payload
+        payload = ''
+      packet = routing + payload
+
+      # Drop those packets we shouldn't send to APRS-IS, cheap substring tests first
+      if (len(payload) == 0):
+        print(">>> No payload, not igated:  " + packet)   # aprs-is servers also notice and drop empty packets, no spec for this
+        continue
+      if (',TCP' in routing):                       # drop packets sourced from internet
+        print(">>> Internet packet not igated:  " + packet)
+        continue
+      if ('RFONLY' in routing):
+        print(">>> RFONLY, not igated: " + packet)
+        continue
+      if ('NOGATE' in routing):
+        print(">>> NOGATE, not igated: " + packet)
+        continue
+      if (thirdparty_tcp(payload)):      # drop packets sourced from internet in third party packets
+        print(">>> Internet packet not igated:  " + packet)
         continue
 
-      line = line.decode('utf-8', errors='ignore')
-      line = line.strip('\n\r')
-      if (re.search('\[.*\] <UI.*>:', str(line))):     # Yaesu's nmea9-formatted suffix means we found a routing block
-        routing = line
-        routing = re.sub(' \[.*\] <UI.*>:', ',qAO,' + USER + ':', routing)  # drop nmea/yaesu gunk, append us to routing block
-        payload = ser.readline()                     # next non-empty line is the payload, strip random number of yaesu line feeds
-        payload = payload.decode('utf-8', errors='ignore')
-        payload = payload.strip('\n\r')
-        packet = routing + payload
-
-        # Drop those packets we shouldn't send to APRS-IS
-        if (len(payload) == 0):
-          print(">>> No payload, not igated:  " + packet)   # aprs-is servers also notice and drop empty packets, no spec for this
-          continue
-        if (re.search(',TCP', routing)):            # drop packets sourced from internet
-          print(">>> Internet packet not igated:  " + packet)
-          continue
-        if (re.search('^}.*,TCP.*:', payload)):     # drop packets sourced from internet in third party packets
-          print(">>> Internet packet not igated:  " + packet)
-          continue
-        if ('RFONLY' in routing):
-          print(">>> RFONLY, not igated: " + packet)
-          continue
-        if ('NOGATE' in routing):
-          print(">>> NOGATE, not igated: " + packet)
-          continue
-
-        # Send the packet to APRS-IS
-        print("[0.0] " + packet)
-        if (send_to_server(packet + "\r\n") == False):
-          reset_socket()
-          time.sleep(5)
-          run_state = AprsIsState.NOCONNECT
-
-        # Check to see if its time to beacon
-        current_time = time.time()
-        if (current_time - last_beacon_time > BEACON_INTERVAL_S):
-          cpu = CPUTemperature()
-          MY_SYSTEM_DATA_STRING = " CPUTemp:" + str(round(cpu.temperature, 1)) + "C"
-          if (send_to_server(MY_POSITION_STRING + MY_SYSTEM_DATA_STRING + "\r\n") == False):
-            reset_socket()
-            time.sleep(5)
-            run_state = AprsIsState.NOCONNECT
-          else:
-            print(MY_POSITION_STRING + MY_SYSTEM_DATA_STRING)
-            last_beacon_time = current_time
-
-# We never get here, but these things happen in the ctrl-c handler
-ser.close()
-sock.shutdown(0)
-sock.close()
+      # Send the packet to APRS-IS
+      print("[0.0] " + packet)
+      await send((packet + "\r\n").encode('utf-8'))
+
+# Drain server keepalives/comments so the socket is always watched, EOF means the server dropped us
+async def read_server():
+  while True:
+    await read_server_line()
+
+# My position and telemetry definition frames
+def beacon_frames():
+  print(MY_POSITION_STRING)
+  print(PREFIX + PARAMETER_NAMES)
+  print(PREFIX + UNIT_MESSAGE)
+  print(PREFIX + EQUATION_COEF)
+  #print(OBJ1_STRING)
+  return (_MY_POSITION_B, _PARAMS_B, _UNITS_B, _EQNS_B)   # add (OBJ1_STRING + "\r\n").encode('utf-8') to beacon the object
+
+# Telemetry frame, advances the sequence number
+def telemetry_frames():
+  global SEQUENCE_NUMBER
+  temperature = _cpu_temp_c()
+  load = int(round(getLoadAvg() / _CPU_COUNT * 100))
+  print("CPU Temp: " + str(round(temperature, 1)) + "CPU Load: " + str(load) + "%")
+  th = readDht22()
+  telem = b"T#" + _enc3(SEQUENCE_NUMBER) + b"," + _enc3(round(temperature*2)) + b"," + _enc3(load)
+  if th is not None:          # leave the shack fields out until the DHT22 has been read
+    telem += b"," + th
+  SEQUENCE_NUMBER = (SEQUENCE_NUMBER + 1) % 1000
+  print(PREFIX + telem.decode())
+  return (_PREFIX_B, telem, _CRLF)
+
+# Periodic events as (interval, frame builder), all fire once right after login
+PERIODIC_EVENTS = ((BEACON_INTERVAL_S, beacon_frames), (TELEMETRY_INTERVAL_S, telemetry_frames))
+
+# Run the periodic events off a min-heap of monotonic deadlines, the heap is owned
+# by main() so deadlines survive reconnects. Frames from events due together go out
+# in one write / TCP segment
+async def scheduler(events):
+  loop = asyncio.get_running_loop()
+  while True:
+    now = loop.time()
+    frames = []
+    while events[0][0] <= now:
+      deadline, n, interval, callback = heapq.heappop(events)
+      frames.extend(callback())
+      deadline += interval
+      if deadline <= now:     # missed ticks after a stall/outage, skip them rather than firing again now
+        deadline = now + interval
+      heapq.heappush(events, (deadline, n, interval, callback))
+    if frames:
+      await send_to_server(*frames)
+    await asyncio.sleep(max(0, events[0][0] - loop.time()))
+
+# Sample the DHT22 in a worker thread, read_retry bit-bangs the sensor and can block for seconds
+async def dht_task():
+  global _dht_latest
+  loop = asyncio.get_running_loop()
+  while True:
+    try:
+      h,t = await loop.run_in_executor(None, dht.read_retry, dht.DHT22, DHT)
+    except Exception as e:
+      print(">>> FAILED to read DHT22 on pin " + str(DHT))
+      print(e)
+    else:
+      if h is not None and t is not None:
+        _dht_latest = (t, h, time.monotonic())
+      else:
+        print(">>> FAILED to read DHT22 on pin " + str(DHT))
+    _dht_first_read.set()
+    await asyncio.sleep(DHT_INTERVAL_S)
+
+async def main():
+  global ser_reader, ser_writer, _dht_first_read
+
+  # Open the specified serial port
+  try:
+    ser_reader, ser_writer = await serial_asyncio_fast.open_serial_connection(url=SERIAL_PORT, baudrate=9600)
+  except Exception as e:
+    print(">>> FAILED to open " + SERIAL_PORT + "\n")
+    print(e)
+    _die(1)  # If we can't do this, we're done!
+
+  # Give the DHT22 a chance at a first reading so the first telemetry frame has it
+  _dht_first_read = asyncio.Event()
+  dht_reader = asyncio.create_task(dht_task())
+  try:
+    await asyncio.wait_for(_dht_first_read.wait(), DHT_FIRST_READ_S)
+  except asyncio.TimeoutError:
+    print(">>> No DHT22 reading yet, starting without it")
+
+  # Periodic event deadlines, all due on the first login only
+  now = asyncio.get_running_loop().time()
+  events = [(now, n, interval, callback) for n, (interval, callback) in enumerate(PERIODIC_EVENTS)]
+  heapq.heapify(events)
+
+  # Any socket error, connecting or sending, tears down the session and we reconnect.
+  # A serial fault is fatal instead, reconnecting to aprs-is won't bring the radio back
+  try:
+    while True:
+      tasks = []
+      try:
+        await connect_to_server()
+        tasks = [asyncio.create_task(c) for c in (read_radio(), read_server(), scheduler(events))]
+        await asyncio.gather(*tasks)
+      except (serial.SerialException, EOFError) as e:   # SerialException is an OSError, check it first
+        print(">>> FAILED reading " + SERIAL_PORT + "\n")
+        print(e)
+        _die(1)  # If we can't do this, we're done!
+      except OSError as e:
+        print(">>> FAILED connection to " + HOST + "\n")
+        print(e)
+      finally:
+        for task in tasks:
+          task.cancel()
+      reset_socket()
+      await asyncio.sleep(5)
+  finally:                    # ctrl-c cancels us, clean up the ports on the way out
+    dht_reader.cancel()
+    writer = sock_writer
+    reset_socket()
+    if writer is not None:
+      try:
+        await writer.wait_closed()
+      except OSError:
+        pass
+    ser_writer.close()
+
+
+ser_reader, ser_writer = None, None
+sock_reader, sock_writer = None, None
+
+# asyncio.run() turns ctrl-c into a cancel of main() and re-raises it here
+try:
+  asyncio.run(main())
+except KeyboardInterrupt:
+  print(">>> Ctrl+C detected, exiting...")